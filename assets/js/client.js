@@ -0,0 +1,192 @@
+// Client-side listing: fetches the columnar JSON listing a page at a time
+// and only keeps the rows in view in the DOM.
+$(document).ready(function(){
+    var ROW_HEIGHT = 32;
+    var PAGE_SIZE = 500;
+    var OVERSCAN = 20;
+
+    var state;
+    var $viewport = $('#client-viewport');
+    var $rows = $('#client-rows');
+
+    function currentPath() {
+        var path = decodeURI(location.hash.replace(/^#/, '')) || '/';
+        if (path.charAt(path.length - 1) != '/') {
+            path += '/';
+        }
+        return path;
+    }
+
+    function encodePath(path) {
+        return path.split('/').map(encodeURIComponent).join('/');
+    }
+
+    function sizeFmt(size) {
+        var units = ['Bytes', 'kB', 'MB', 'GB', 'TB', 'PB'];
+        var i = 0;
+        while (size >= 1000 && i < units.length - 1) {
+            size /= 1000;
+            i++;
+        }
+        return i ? size.toFixed(1) + ' ' + units[i] : size + ' Bytes';
+    }
+
+    function timeFmt(mtime) {
+        var date = new Date(mtime * 1000);
+        var pad = function(n){ return n < 10 ? '0' + n : n; };
+        return date.getFullYear() + '-' + pad(date.getMonth() + 1) + '-' +
+            pad(date.getDate()) + ' ' + pad(date.getHours()) + ':' +
+            pad(date.getMinutes()) + ':' + pad(date.getSeconds());
+    }
+
+    function cookieDotfile() {
+        var match = document.cookie.match(/(?:^|; )hide-dotfile=([^;]*)/);
+        return match ? match[1] : 'no';
+    }
+
+    function reset() {
+        state = {
+            path: currentPath(),
+            sorting: state ? state.sorting : '',
+            hideDotfile: state ? state.hideDotfile : cookieDotfile(),
+            columns: {name: [], type: [], size: [], mtime: []},
+            next: null,
+            total: null,
+            loading: false,
+            done: false,
+            request: (state ? state.request : 0) + 1
+        };
+        $viewport.scrollTop(0);
+        renderBreadcrumb();
+        fetchPage();
+    }
+
+    function fetchPage() {
+        if (state.loading || state.done) {
+            return;
+        }
+        state.loading = true;
+        var request = state.request;
+        var params = {format: 'json', page_size: PAGE_SIZE};
+        if (state.sorting) {
+            params.sorting = state.sorting;
+        }
+        if (state.hideDotfile) {
+            params['hide-dotfile'] = state.hideDotfile;
+        }
+        if (state.next) {
+            params.after = state.next;
+        }
+        $.getJSON(encodePath(state.path), params, function(data){
+            if (request != state.request) {
+                return;
+            }
+            $.each(state.columns, function(column, values){
+                Array.prototype.push.apply(values, data.columns[column]);
+            });
+            state.total = data.total;
+            state.next = data.next;
+            state.done = !data.next;
+            state.loading = false;
+            render();
+        }).fail(function(){
+            state.loading = false;
+            state.done = true;
+        });
+    }
+
+    function render() {
+        var count = state.columns.name.length;
+        var rowCount = count;
+        if (state.total) {
+            rowCount = Math.max(count, state.total.dir + state.total.file);
+        }
+        $rows.height(rowCount * ROW_HEIGHT);
+
+        var top = $viewport.scrollTop();
+        var first = Math.max(Math.floor(top / ROW_HEIGHT) - OVERSCAN, 0);
+        var last = Math.min(
+            Math.ceil((top + $viewport.height()) / ROW_HEIGHT) + OVERSCAN,
+            count
+        );
+        var html = [];
+        for (var i = first; i < last; i++) {
+            html.push(renderRow(i));
+        }
+        $rows.html(html.join(''));
+
+        if (last + OVERSCAN >= count) {
+            fetchPage();
+        }
+        if (state.total) {
+            $('#client-total').text(
+                state.total.dir + ' folders and ' + state.total.file +
+                ' files' + (state.total.size === null ? '' :
+                ', ' + sizeFmt(state.total.size) + ' in total')
+            );
+        }
+    }
+
+    function renderRow(i) {
+        var columns = state.columns;
+        var name = columns.name[i];
+        var isDir = columns.type[i] == 'dir';
+        var href = isDir ? '#' + encodePath(state.path + name) + '/' :
+            encodePath(state.path + name);
+        return '<div class="client-row" style="top:' + i * ROW_HEIGHT +
+            'px"><span class="client-name"><i class="fa fa-fw ' +
+            (isDir ? 'fa-folder' : 'fa-file-o') + '"></i>&nbsp;' +
+            '<a href="' + href + '">' + (isDir ? '<strong>' : '') +
+            $('<span>').text(name).html() + (isDir ? '</strong>' : '') +
+            '</a></span><span class="client-size">' +
+            (isDir ? '&mdash;' : sizeFmt(columns.size[i])) +
+            '</span><span class="client-mtime">' +
+            timeFmt(columns.mtime[i]) + '</span></div>';
+    }
+
+    function renderBreadcrumb() {
+        var $breadcrumb = $('#client-breadcrumb').empty();
+        var href = '#/';
+        $breadcrumb.append(
+            '<li class="breadcrumb-item"><a href="#/">' +
+            '<i class="fa fa-fw fa-home fa-lg"></i></a></li>'
+        );
+        $.each(state.path.split('/'), function(_, part){
+            if (!part) {
+                return;
+            }
+            href += encodeURIComponent(part) + '/';
+            $('<li class="breadcrumb-item"><a><strong></strong></a></li>')
+                .find('a').attr('href', href).end()
+                .find('strong').text(part).end()
+                .appendTo($breadcrumb);
+        });
+        $('#client-classic').attr('href', encodePath(state.path));
+        $('#client-dotfiles').text(
+            state.hideDotfile == 'yes' ? 'Show Dotfiles' : 'Hide Dotfiles'
+        );
+    }
+
+    $viewport.on('scroll', function(){
+        window.requestAnimationFrame(render);
+    });
+    $(window).on('resize', render);
+    $(window).on('hashchange', reset);
+
+    $('[data-sorting]').click(function(e){
+        e.preventDefault();
+        var sorting = $(this).data('sorting');
+        state.sorting = state.sorting == sorting ?
+            (sorting.charAt(0) == '-' ? sorting.slice(1) : '-' + sorting) :
+            sorting;
+        reset();
+    });
+
+    $('#client-dotfiles').click(function(e){
+        e.preventDefault();
+        state.hideDotfile = state.hideDotfile == 'yes' ? 'no' : 'yes';
+        reset();
+    });
+
+    reset();
+});
@@ -1,3 +1,125 @@
+// Files are sent in chunks, several at a time and in any order. After a
+// failure the server is asked which ranges it already has, and only the
+// missing chunks are sent again
+var chunkSize = 8 * 1024 * 1024;
+var parallelChunks = 4;
+var maxRetries = 5;
+
+function showResult(el, ok, msg){
+    var parent = el.find(".jFiler-jProgressBar").parent();
+    el.find(".jFiler-jProgressBar").fadeOut("slow", function(){
+        if (ok) {
+            $("<div class=\"jFiler-item-others text-success\"><i class=\"icon-jfi-check-circle\"></i> Success</div>").hide().appendTo(parent).fadeIn("slow");
+        } else {
+            $("<div class=\"jFiler-item-others text-error\"><i class=\"icon-jfi-minus-circle\"></i> Error" + (msg ? ": " + msg : "") + "</div>").hide().appendTo(parent).fadeIn("slow");
+        }
+    });
+}
+
+function parseRanges(header){
+    // "0-99,200-299" -> [[0, 100], [200, 300]]
+    return (header || "").split(",").filter(Boolean).map(function(range){
+        var bounds = range.split("-");
+        return [parseInt(bounds[0], 10), parseInt(bounds[1], 10) + 1];
+    });
+}
+
+function missingChunks(size, ranges){
+    var chunks = [];
+    for (var start = 0; start < size; start += chunkSize) {
+        var end = Math.min(start + chunkSize, size);
+        var received = ranges.some(function(range){
+            return range[0] <= start && end <= range[1];
+        });
+        if (!received) {
+            chunks.push([start, end]);
+        }
+    }
+    return chunks;
+}
+
+function sendChunks(file, el, location, ranges, retries){
+    var queue = missingChunks(file.size, ranges);
+    var done = file.size;
+    var active = 0;
+    var failed = false;
+    var finished = false;
+    queue.forEach(function(chunk){
+        done -= chunk[1] - chunk[0];
+    });
+
+    function next(){
+        if (finished) {
+            return;
+        }
+        var chunk = queue.shift();
+        if (failed || !chunk) {
+            // Wait for the chunks in flight, then ask the server
+            if (!active) {
+                resume(file, el, location, retries + 1);
+            }
+            return;
+        }
+        active++;
+        $.ajax({
+            url: location,
+            type: "PATCH",
+            data: file.slice(chunk[0], chunk[1]),
+            processData: false,
+            contentType: "application/offset+octet-stream",
+            headers: {"Upload-Offset": chunk[0]}
+        }).done(function(data){
+            active--;
+            done += chunk[1] - chunk[0];
+            el.find(".jFiler-jProgressBar .bar").css("width", done / file.size * 100 + "%");
+            if (data.complete) {
+                finished = true;
+                showResult(el, true);
+            }
+            next();
+        }).fail(function(){
+            active--;
+            failed = true;
+            next();
+        });
+    }
+
+    for (var i = 0; i < parallelChunks; i++) {
+        next();
+    }
+}
+
+function resume(file, el, location, retries){
+    if (retries > maxRetries) {
+        showResult(el, false);
+        return;
+    }
+    setTimeout(function(){
+        $.ajax({url: location, type: "HEAD"}).done(function(data, status, xhr){
+            var ranges = parseRanges(xhr.getResponseHeader("Upload-Ranges"));
+            sendChunks(file, el, location, ranges, retries);
+        }).fail(function(){
+            resume(file, el, location, retries + 1);
+        });
+    }, 1000 * retries);
+}
+
+function upload(file, el){
+    $.ajax({
+        url: $('#filer_input').data('uploads') + window.location.pathname + "?name=" + encodeURIComponent(file.name),
+        type: "POST",
+        headers: {"Upload-Length": file.size}
+    }).done(function(data, status, xhr){
+        if (data.complete) {
+            showResult(el, true);
+        } else {
+            sendChunks(file, el, xhr.getResponseHeader("Location"), [], 0);
+        }
+    }).fail(function(xhr){
+        showResult(el, false, xhr.responseJSON && xhr.responseJSON.msg);
+    });
+}
+
 $(document).ready(function(){
     $('#filer_input').filer({
         showThumbs: true,
@@ -17,33 +139,11 @@ $(document).ready(function(){
                 remove: '.jFiler-item-trash-action'
             }
         },
-        uploadFile: {
-            url: "#",
-            data: {},
-            type: 'POST',
-            enctype: 'multipart/form-data',
-            beforeSend: function(){},
-            success: function(data, el){
-                var parent = el.find(".jFiler-jProgressBar").parent();
-                if (data.status == 'success') {
-                    el.find(".jFiler-jProgressBar").fadeOut("slow", function(){
-                        $("<div class=\"jFiler-item-others text-success\"><i class=\"icon-jfi-check-circle\"></i> Success</div>").hide().appendTo(parent).fadeIn("slow");
-                    });
-                } else {
-                    el.find(".jFiler-jProgressBar").fadeOut("slow", function(){
-                        $("<div class=\"jFiler-item-others text-error\"><i class=\"icon-jfi-minus-circle\"></i> Error: " + data.msg + "</div>").hide().appendTo(parent).fadeIn("slow");
-                    });
-                }
-            },
-            error: function(el){
-                var parent = el.find(".jFiler-jProgressBar").parent();
-                el.find(".jFiler-jProgressBar").fadeOut("slow", function(){
-                    $("<div class=\"jFiler-item-others text-error\"><i class=\"icon-jfi-minus-circle\"></i> Error</div>").hide().appendTo(parent).fadeIn("slow");
-                });
-            },
-            statusCode: null,
-            onProgress: null,
-            onComplete: null
+        // Uploads go through the resumable endpoint (see upload() below);
+        // an empty uploadFile only makes the filer draw progress bars
+        uploadFile: {},
+        onSelect: function(file, el){
+            upload(file, el);
         },
         captions: {
             button: "Add Files",
@@ -0,0 +1,94 @@
+"""Compare the os.listdir + os.stat listing with the os.scandir one.
+
+Builds a synthetic directory (100k entries by default, 10% of them
+subdirectories) and times classifying entries as dirs/files and
+collecting their sizes, counting the os.stat calls each pipeline makes.
+DirEntry.stat() is not counted: on POSIX it is one stat per entry, made
+only when the size or mtime is actually needed.
+
+    python benchmarks/bench_listing.py --entries 100000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import file_server  # noqa: E402
+
+calls = {"stat": 0}
+real_stat = os.stat
+
+
+def counting_stat(*args, **kwargs):
+    calls["stat"] += 1
+    return real_stat(*args, **kwargs)
+
+
+def listdir_files(path):
+    # The listing before os.scandir: File has no DirEntry to reuse
+    for name in os.listdir(path):
+        yield file_server.File(os.path.join(path, name), path)
+
+
+def listdir_types(path):
+    return [f.type for f in listdir_files(path)]
+
+
+def listdir_sizes(path):
+    return [(f.type, f.size) for f in listdir_files(path)]
+
+
+def scandir_types(path):
+    return [f.type for f in file_server.iter_files(path)]
+
+
+def scandir_sizes(path):
+    return [(f.type, f.size) for f in file_server.iter_files(path)]
+
+
+def measure(func, path):
+    calls["stat"] = 0
+    start = time.perf_counter()
+    func(path)
+    return time.perf_counter() - start, calls["stat"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        for i in range(args.entries):
+            name = os.path.join(path, "entry{0:07d}".format(i))
+            if i % 10 == 0:
+                os.mkdir(name)
+            else:
+                open(name, "w").close()
+
+        os.stat = counting_stat
+        for label, func in (
+            ("listdir types", listdir_types),
+            ("scandir types", scandir_types),
+            ("listdir sizes", listdir_sizes),
+            ("scandir sizes", scandir_sizes),
+        ):
+            elapsed, stats = measure(func, path)
+            print(
+                "{0:<14} {1:8.3f}s {2:8d} os.stat calls".format(
+                    label, elapsed, stats
+                )
+            )
+    finally:
+        os.stat = real_stat
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
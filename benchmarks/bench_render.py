@@ -0,0 +1,101 @@
+"""Time the per-row template filters and a full 10k-row listing render.
+
+Compares the extension registry with the previous data_fmt/icon_fmt,
+which scanned every entry of datatypes/icontypes per row.
+
+    python benchmarks/bench_render.py --rows 10000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import file_server  # noqa: E402
+
+EXTENSIONS = ["mp3", "jpg", "py", "txt", "mkv", "html", "pdf", "tar", "s"]
+
+
+def scan_data_fmt(filename):
+    t = "unknown"
+    for type, exts in file_server.datatypes.items():
+        if filename.split(".")[-1] in exts:
+            t = type
+    return t
+
+
+def scan_icon_fmt(filename):
+    i = "fa-file-o"
+    for icon, exts in file_server.icontypes.items():
+        if filename.split(".")[-1] in exts:
+            i = icon
+    return i
+
+
+def filters(names, data_fmt, icon_fmt):
+    start = time.perf_counter()
+    for name in names:
+        data_fmt(name)
+        icon_fmt(name)
+    return time.perf_counter() - start
+
+
+def render(path, rows):
+    with file_server.app.test_request_context(
+        "/?page_size={0}&hide-dotfile=no".format(rows)
+    ):
+        start = time.perf_counter()
+        response = file_server.PathView().get("")
+        size = sum(len(chunk) for chunk in response.response)
+        return time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    names = [
+        "file{0}.{1}".format(i, EXTENSIONS[i % len(EXTENSIONS)])
+        for i in range(args.rows)
+    ]
+    print(
+        "filters, scan:     {0:.3f}s".format(
+            filters(names, scan_data_fmt, scan_icon_fmt)
+        )
+    )
+    print(
+        "filters, registry: {0:.3f}s".format(
+            filters(names, file_server.data_fmt, file_server.icon_fmt)
+        )
+    )
+
+    path = tempfile.mkdtemp()
+    try:
+        for name in names:
+            open(os.path.join(path, name), "w").close()
+        file_server.root = path
+        file_server.compress_listings = False
+        render(path, args.rows)
+        env = file_server.app.jinja_env.filters
+        for label, data_fmt, icon_fmt in (
+            ("scan", scan_data_fmt, scan_icon_fmt),
+            ("registry", file_server.data_fmt, file_server.icon_fmt),
+        ):
+            env["data_fmt"], env["icon_fmt"] = data_fmt, icon_fmt
+            elapsed, size = render(path, args.rows)
+            print(
+                "render, {0:<9} {1:.3f}s {2} bytes".format(
+                    label + ":", elapsed, size
+                )
+            )
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Compare download throughput with and without ``use_sendfile``.
+
+Serves a generated file through gunicorn and downloads it whole and as a
+``bytes=1-`` range, reporting MB/s and the CPU time used by the worker.
+
+    python benchmarks/bench_sendfile.py --size 1024
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import file_server  # noqa: E402
+
+PORT = 8765
+
+
+def serve(root, sendfile):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "127.0.0.1:{0}".format(PORT))
+            self.cfg.set("workers", 1)
+            self.cfg.set("sendfile", True)
+            self.cfg.set("loglevel", "warning")
+
+        def load(self):
+            return file_server.app
+
+    file_server.root = root
+    file_server.use_sendfile = sendfile
+    Server().run()
+
+
+def worker_cpu(pid):
+    # utime + stime of the gunicorn workers forked by the arbiter
+    total = 0
+    with open("/proc/{0}/task/{0}/children".format(pid)) as f:
+        children = f.read().split()
+    for child in children:
+        with open("/proc/{0}/stat".format(child)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def download(headers):
+    for _ in range(50):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT)
+            conn.request("GET", "/bench.bin", headers=headers)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    response = conn.getresponse()
+    received = 0
+    while True:
+        chunk = response.read(1024 * 1024)
+        if not chunk:
+            break
+        received += len(chunk)
+    conn.close()
+    return received
+
+
+def run(root, sendfile, headers):
+    server = multiprocessing.Process(target=serve, args=(root, sendfile))
+    server.start()
+    try:
+        download({"Range": "bytes=0-0"})
+        cpu = worker_cpu(server.pid)
+        start = time.time()
+        received = download(headers)
+        elapsed = time.time() - start
+        cpu = worker_cpu(server.pid) - cpu
+    finally:
+        server.terminate()
+        server.join()
+    return received / elapsed / 1e6, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1024, help="MiB")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, "bench.bin")
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(args.size):
+            f.write(block)
+
+    try:
+        for label, headers in (("full", {}), ("range", {"Range": "bytes=1-"})):
+            for sendfile in (False, True):
+                rate, cpu = run(root, sendfile, headers)
+                print(
+                    "{0:<6} use_sendfile={1!s:<5} {2:8.1f} MB/s "
+                    "{3:6.2f}s worker CPU".format(label, sendfile, rate, cpu)
+                )
+    finally:
+        os.remove(path)
+        os.rmdir(root)
+
+
+if __name__ == "__main__":
+    main()
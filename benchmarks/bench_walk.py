@@ -0,0 +1,74 @@
+"""Scaling of recursive walks with the size of the walker thread pool.
+
+Builds a deep synthetic tree (or walks --root, e.g. an NFS mount) and
+times a full recursive walk with sizes stat'ed for each walk_workers
+value. Directory reads are latency-bound on network filesystems, which
+is where extra workers pay off; on a local page-cached tree the GIL
+keeps the curve flat.
+
+    python benchmarks/bench_walk.py --fanout 4 --depth 6 --files 10
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import file_server  # noqa: E402
+
+
+def build(path, fanout, depth, files):
+    for i in range(files):
+        open(os.path.join(path, "file{0}".format(i)), "w").close()
+    if depth:
+        for i in range(fanout):
+            subdir = os.path.join(path, "dir{0}".format(i))
+            os.mkdir(subdir)
+            build(subdir, fanout, depth - 1, files)
+
+
+def walk(path):
+    count = size = 0
+    for file in file_server.iter_recursive_files(path):
+        count += 1
+        size += file.size
+    return count, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", help="walk an existing tree instead")
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--workers", default="1,2,4,8,16,32")
+    args = parser.parse_args()
+
+    path = args.root or tempfile.mkdtemp()
+    try:
+        if not args.root:
+            build(path, args.fanout, args.depth, args.files)
+        walk(path)
+        baseline = None
+        for workers in map(int, args.workers.split(",")):
+            file_server.walk_workers = workers
+            start = time.perf_counter()
+            count, size = walk(path)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(
+                "workers={0:<3} {1:8.3f}s {2:6.2f}x  {3} files".format(
+                    workers, elapsed, baseline / elapsed, count
+                )
+            )
+    finally:
+        if not args.root:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,122 @@
+import base64
+import bisect
+import collections
+import ctypes
+import ctypes.util
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import mimetypes
+import operator
 import os
 import re
 import stat
+import struct
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import quote
 
-import furl
 import humanize
 from cached_property import cached_property
 from flask import (
     Flask,
     Response,
+    g,
     make_response,
-    render_template,
     request,
-    send_file,
+    stream_with_context,
 )
 from flask.views import MethodView
 from werkzeug import secure_filename
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import parse_date, quote_etag
+from werkzeug.urls import url_encode
 import jinja2
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 app = Flask(__name__, static_url_path="/assets", static_folder="assets")
 root = os.path.expanduser("~")
+chunk_size = 64 * 1024
+# Pass range bodies to the server's wsgi.file_wrapper so it can sendfile them
+use_sendfile = False
+# Let the reverse proxy send file bodies: "x-accel-redirect" (nginx) or
+# "x-sendfile" (Apache mod_xsendfile, lighttpd)
+offload = None
+offload_prefix = "/_protected/"
+# The server's own endpoints (resumable uploads, stats) live below this
+# path, which shadows a directory of that name in root
+api_prefix = "/_file_server/"
+# Serve cache and blob store counters at <api_prefix>stats
+expose_stats = False
+# More ranges than this in one request get the whole file instead
+max_ranges = 16
+# When sorting by name, stat only the rows of the requested page
+lazy_stat = False
+# Directory listings kept in memory, revalidated against the directory's
+# mtime and inode. File sizes can change without touching the directory,
+# so entries are also rebuilt after listing_cache_ttl seconds
+listing_cache_size = 256
+listing_cache_files = 500000
+listing_cache_ttl = 60
+# Keep indexed directories current from inotify events instead (Linux).
+# Directories that cannot be watched fall back to the listing cache
+watch_root = False
+# Threads reading directories ahead of recursive walks, and how many
+# directories each walk may have queued or buffered
+walk_workers = 8
+walk_queue_depth = 64
+walk_follow_symlinks = False
+# Gzip streamed listings for clients that accept it
+compress_listings = True
+# Use a digest of the contents as the ETag of downloads, so replicas
+# serving the same bytes agree. Digests are kept per inode, size and mtime
+etag_content_hash = False
+content_hash_cache_size = 4096
+# Paths found missing are answered with 404 from memory for this many
+# seconds, so crawlers probing for files do not reach the disk
+missing_cache_ttl = 5
+missing_cache_size = 10000
+# Uploads are written next to their destination under this prefix and
+# renamed into place once complete. Such names never show in listings
+upload_prefix = ".upload-"
+# Resumable uploads left untouched for this long are removed when another
+# one starts in the same directory
+upload_expiry = 7 * 24 * 3600
+# Content-addressed store for uploads: a directory on the same filesystem
+# as root. Uploaded files are reflinked to blobs named by their SHA-256,
+# and a client that knows a file's hash can create it without sending it
+# (POST /<dir>/?dedup=<sha256>&name=<file>)
+blob_store = None
+# Fall back to hardlinks where the filesystem cannot reflink (ext4...).
+# The copies then share the blob's inode: blobs are made read-only and
+# are not reused once their size or mtime changed, but root can still
+# edit any copy in place
+blob_hardlinks = False
+# Datatypes already compressed: ZIP archives store them without deflate
+compressed_datatypes = {"archive", "audio", "image", "quicktime", "video"}
+# CRCs of files sent in stored ZIPs, so a resumed download does not have
+# to reread the files it already got to write the central directory
+crc_cache_size = 100000
+# Directory, outside root, where those CRCs are also written so that
+# other workers and restarts find them; one small file per served file
+crc_store = None
 
 ignored = [
     ".bzr",
@@ -77,22 +172,48 @@ def time_desc(timestamp):
     return str
 
 
+def build_extensions():
+    # extension -> (datatype, icon, mimetype); rebuild after changing
+    # datatypes or icontypes: extensions = build_extensions()
+    # types_map only holds the built-in table until the system databases
+    # (/etc/mime.types and the like) are loaded
+    mimetypes.init()
+    registry = {
+        ext.lstrip(".").lower(): ["unknown", "fa-file-o", mimetype]
+        for ext, mimetype in mimetypes.types_map.items()
+    }
+    for index, types in ((0, datatypes), (1, icontypes)):
+        for value, exts in types.items():
+            for ext in exts.split(","):
+                ext = ext.strip().lower()
+                registry.setdefault(ext, ["unknown", "fa-file-o", None])
+                registry[ext][index] = value
+    return {ext: tuple(info) for ext, info in registry.items()}
+
+
+extensions = build_extensions()
+unknown_extension = ("unknown", "fa-file-o", None)
+
+
+def extension_info(filename):
+    _, dot, ext = filename.rpartition(".")
+    if not dot:
+        return unknown_extension
+    return extensions.get(ext.lower(), unknown_extension)
+
+
+def guess_mimetype(path):
+    return extension_info(os.path.basename(path))[2]
+
+
 @app.template_filter("data_fmt")
 def data_fmt(filename):
-    t = "unknown"
-    for type, exts in datatypes.items():
-        if filename.split(".")[-1] in exts:
-            t = type
-    return t
+    return extension_info(filename)[0]
 
 
 @app.template_filter("icon_fmt")
 def icon_fmt(filename):
-    i = "fa-file-o"
-    for icon, exts in icontypes.items():
-        if filename.split(".")[-1] in exts:
-            i = icon
-    return i
+    return extension_info(filename)[1]
 
 
 @app.template_filter("humanize")
@@ -102,103 +223,1306 @@ def time_humanize(timestamp):
 
 
 @jinja2.contextfilter
-def set_param(context, param, value):
-    f = furl.furl(request.full_path)
-    f.args[param] = value
-    return f.url
+def set_param(context, param, value, **params):
+    # The same few links repeat on a page, so each is built once per
+    # request. Keyword arguments set more parameters; None removes one
+    params[param] = value
+    key = tuple(sorted(params.items()))
+    urls = g.setdefault("param_urls", {})
+    if key not in urls:
+        args = request.args.copy()
+        for name, value in params.items():
+            if value is None:
+                args.pop(name, None)
+            else:
+                args[name] = value
+        urls[key] = quote(request.path) + "?" + url_encode(args)
+    return urls[key]
 
 
 app.jinja_env.filters["set_param"] = set_param
 
 
-def partial_response(path, start, end=None):
-    file_size = os.path.getsize(path)
-
-    if end is None:
-        end = file_size - 1
-    length = end - start + 1
-
+def iter_file_range(path, start, length):
     with open(path, "rb") as fd:
         fd.seek(start)
-        bytes = fd.read(length)
-    assert len(bytes) == length
-
-    response = Response(
-        bytes,
-        206,
-        mimetype=mimetypes.guess_type(path)[0],
-        direct_passthrough=True,
-    )
-    response.headers.add(
-        "Content-Range", "bytes {0}-{1}/{2}".format(start, end, file_size)
-    )
+        while length > 0:
+            chunk = fd.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+class FileRange:
+    # What file_body hands to wsgi.file_wrapper: reads stop after length
+    # bytes, as some wrappers (wsgiref) read to EOF whatever the
+    # Content-Length. fileno() still lets servers that bound the body by
+    # Content-Length (gunicorn) send it with os.sendfile
+    def __init__(self, path, start, length):
+        self.file = open(path, "rb")
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def file_body(path, start, length):
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if not use_sendfile or file_wrapper is None:
+        return iter_file_range(path, start, length)
+    return file_wrapper(FileRange(path, start, length), chunk_size)
+
+
+def partial_response(read, ranges, file_size, mimetype, body=None):
+    # read(start, length) yields the bytes of a range; body, when given,
+    # builds the body of a single range response instead (see file_body)
+    mimetype = mimetype or "application/octet-stream"
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = Response(
+            (body or read)(start, end - start + 1),
+            206,
+            mimetype=mimetype,
+            direct_passthrough=True,
+        )
+        response.headers.add(
+            "Content-Range",
+            "bytes {0}-{1}/{2}".format(start, end, file_size),
+        )
+        response.headers.add("Content-Length", str(end - start + 1))
+    else:
+        boundary = uuid.uuid4().hex
+        heads = [
+            (
+                "\r\n--{0}\r\nContent-Type: {1}\r\n"
+                "Content-Range: bytes {2}-{3}/{4}\r\n\r\n".format(
+                    boundary,
+                    mimetype,
+                    start,
+                    end,
+                    file_size,
+                )
+            ).encode("latin-1")
+            for start, end in ranges
+        ]
+        tail = "\r\n--{0}--\r\n".format(boundary).encode("latin-1")
+        length = len(tail) + sum(
+            len(head) + end - start + 1
+            for head, (start, end) in zip(heads, ranges)
+        )
+        response = Response(
+            iter_multipart_ranges(read, ranges, heads, tail),
+            206,
+            mimetype="multipart/byteranges; boundary=" + boundary,
+            direct_passthrough=True,
+        )
+        response.headers.add("Content-Length", str(length))
     response.headers.add("Accept-Ranges", "bytes")
     return response
 
 
-def get_range(request):
-    range = request.headers.get("Range")
-    m = re.match(r"bytes=(?P<start>\d+)-(?P<end>\d+)?", range)
-    if m:
-        start = m.group("start")
-        end = m.group("end")
-        start = int(start)
-        if end is not None:
-            end = int(end)
-        return start, end
+def iter_multipart_ranges(read, ranges, heads, tail):
+    for head, (start, end) in zip(heads, ranges):
+        yield head
+        for chunk in read(start, end - start + 1):
+            yield chunk
+    yield tail
+
+
+content_hashes = collections.OrderedDict()
+content_hashes_lock = threading.Lock()
+
+
+def content_hash(path, st):
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with content_hashes_lock:
+        digest = content_hashes.get(key)
+        if digest is not None:
+            content_hashes.move_to_end(key)
+            return digest
+    h = hashlib.sha256()
+    for chunk in iter_file_range(path, 0, st.st_size):
+        h.update(chunk)
+    digest = h.hexdigest()
+    with content_hashes_lock:
+        content_hashes[key] = digest
+        while len(content_hashes) > content_hash_cache_size:
+            content_hashes.popitem(last=False)
+    return digest
+
+
+def file_etag(path, st):
+    if etag_content_hash:
+        return "{0:x}-{1}".format(st.st_size, content_hash(path, st)[:32])
+    return "{0:x}-{1:x}-{2:x}".format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def not_modified(etag, last_modified):
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified <= since
+
+
+def if_range_matches(etag, last_modified):
+    # If-Range needs a strong match; anything else means the client's copy
+    # is stale and it gets the whole file
+    value = request.headers.get("If-Range")
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith(('"', "W/")):
+        return value == quote_etag(etag)
+    return parse_date(value) == last_modified
+
+
+def ranged_response(read, size, mimetype, etag, last_modified, body=None):
+    # Conditional and Range handling for anything whose bytes can be read
+    # from any offset; read and body are as for partial_response
+    if not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        ranges = None
+        if "Range" in request.headers and if_range_matches(
+            etag, last_modified
+        ):
+            ranges = get_range(request, size)
+        if ranges is None:
+            response = Response(
+                (body or read)(0, size),
+                mimetype=mimetype or "application/octet-stream",
+                direct_passthrough=True,
+            )
+            response.headers.add("Content-Length", str(size))
+            response.headers.add("Accept-Ranges", "bytes")
+        elif ranges:
+            response = partial_response(read, ranges, size, mimetype, body)
+        else:
+            response = range_not_satisfiable(size)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+def file_response(path, st, mimetype):
+    return ranged_response(
+        functools.partial(iter_file_range, path),
+        st.st_size,
+        mimetype,
+        file_etag(path, st),
+        datetime.utcfromtimestamp(int(st.st_mtime)),
+        functools.partial(file_body, path),
+    )
+
+
+def range_not_satisfiable(file_size):
+    response = make_response("Requested range not satisfiable", 416)
+    response.headers.add("Content-Range", "bytes */{0}".format(file_size))
+    return response
+
+
+def offload_response(path, mimetype):
+    response = Response(mimetype=mimetype)
+    if mimetype is None:
+        del response.headers["Content-Type"]
+    if offload == "x-accel-redirect":
+        location = quote("/" + os.path.relpath(path, root))
+        response.headers["X-Accel-Redirect"] = (
+            offload_prefix.rstrip("/") + location
+        )
     else:
-        return 0, None
+        # Header values must be Latin-1 (PEP 3333): send the path
+        # percent-encoded, as mod_xsendfile unescapes it by default
+        response.headers["X-Sendfile"] = quote(path)
+    return response
+
+
+def get_range(request, file_size):
+    # Returns the satisfiable ranges sorted and coalesced, [] when none is
+    # satisfiable, or None when the header should be ignored (RFC 7233)
+    units, _, spec = request.headers.get("Range", "").partition("=")
+    if units.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in spec.split(","):
+        m = re.match(r"^\s*(?P<start>\d*)-(?P<end>\d*)\s*$", spec)
+        if not m or not (m.group("start") or m.group("end")):
+            return None
+        if not m.group("start"):
+            suffix = int(m.group("end"))
+            if suffix == 0 or file_size == 0:
+                continue
+            ranges.append((max(file_size - suffix, 0), file_size - 1))
+            continue
+        start = int(m.group("start"))
+        end = file_size - 1
+        if m.group("end"):
+            end = int(m.group("end"))
+            if end < start:
+                return None
+        if start < file_size:
+            ranges.append((start, min(end, file_size - 1)))
+
+    coalesced = []
+    for start, end in sorted(ranges):
+        if coalesced and start <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], end))
+        else:
+            coalesced.append((start, end))
+    if len(coalesced) > max_ranges:
+        return None
+    return coalesced
+
+
+def resolve_path(p):
+    base = os.path.normpath(root)
+    path = os.path.normpath(os.path.join(base, p))
+    if path != base and not path.startswith(os.path.join(base, "")):
+        return None
+    return path
+
+
+Target = collections.namedtuple("Target", ["path", "stat", "type", "mimetype"])
+
+
+class MissingCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = collections.OrderedDict()
+        self.hits = 0
+
+    def __contains__(self, path):
+        with self.lock:
+            expires = self.paths.get(path)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.paths[path]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, path):
+        if not missing_cache_ttl:
+            return
+        with self.lock:
+            self.paths.pop(path, None)
+            self.paths[path] = time.time() + missing_cache_ttl
+            while len(self.paths) > missing_cache_size:
+                self.paths.popitem(last=False)
+
+    def discard(self, path):
+        with self.lock:
+            self.paths.pop(path, None)
+
+    def stats(self):
+        return {"hits": self.hits, "paths": len(self.paths)}
+
+
+missing_paths = MissingCache()
+
 
+def resolve(p):
+    # One stat per request: everything downstream (dispatch, validators,
+    # headers) works from the returned Target
+    path = resolve_path(p)
+    if path is None or path in missing_paths:
+        return None
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        # ValueError: embedded null byte
+        missing_paths.add(path)
+        return None
+    if stat.S_ISDIR(st.st_mode):
+        return Target(path, st, "dir", None)
+    if stat.S_ISREG(st.st_mode):
+        return Target(path, st, "file", guess_mimetype(path))
+    return None
+
+
+class UploadStream:
+    # Temp file handed to the form parser, hashing what is written to it
+    # when there is a blob store to commit it to
+    def __init__(self, path):
+        self.name = path
+        self.file = open(path, "xb+")
+        self.sha256 = hashlib.sha256() if blob_store else None
+
+    def write(self, data):
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        return self.file.write(data)
 
-def iter_recursive_files(path):
-    for _root, _dirs, _files in os.walk(path):
+    def seek(self, *args):
+        return self.file.seek(*args)
 
-        for _filename in _files:
+    def close(self):
+        self.file.close()
+
+
+def upload_stream_factory(directory, streams):
+    # File parts are written straight into the target directory, so saving
+    # them is a rename instead of a second copy across filesystems
+    def stream_factory(
+        total_content_length, content_type, filename, content_length=None
+    ):
+        stream = UploadStream(
+            os.path.join(directory, upload_prefix + uuid.uuid4().hex)
+        )
+        streams.append(stream)
+        return stream
+
+    return stream_factory
+
+
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    # A reflink keeps both copies independent on filesystems that share
+    # extents (btrfs, XFS); elsewhere the two names share an inode, if
+    # blob_hardlinks allows it. Returns False when neither can be done
+    if fcntl is not None:
+        with open(src, "rb") as source:
+            with open(dst, "xb") as target:
+                try:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                    return True
+                except OSError:
+                    pass
+        os.unlink(dst)
+    if not blob_hardlinks:
+        return False
+    os.link(src, dst)
+    return True
 
-            filepath = os.path.join(path, _root, _filename)
 
-            yield File(filepath, path)
+def rename_into_place(temp, path):
+    # rename(2) does nothing when both names are links to the same inode,
+    # as when a blob is hardlinked over an earlier copy of itself
+    os.replace(temp, path)
+    if os.path.lexists(temp):
+        os.unlink(temp)
+
+
+class BlobStore:
+    digest_pattern = re.compile(r"^[0-9a-f]{64}$")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = 0
+        self.instant = 0
+        self.logical_bytes = 0
+        self.stored_bytes = 0
+
+    def path(self, digest):
+        return os.path.join(blob_store, digest[:2], digest[2:4], digest)
+
+    def seal(self, blob):
+        # Records the blob's size and mtime next to it: a blob that no
+        # longer matches was changed through a hardlinked copy
+        os.chmod(blob, 0o444)
+        st = os.stat(blob)
+        with open(blob + ".meta", "w") as fd:
+            fd.write("{0} {1}".format(st.st_size, st.st_mtime_ns))
+
+    def valid(self, blob):
+        try:
+            with open(blob + ".meta") as fd:
+                size, mtime_ns = map(int, fd.read().split())
+            st = os.stat(blob)
+        except (OSError, ValueError):
+            return False
+        return st.st_size == size and st.st_mtime_ns == mtime_ns
+
+    def discard(self, blob):
+        for path in (blob + ".meta", blob):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def link(self, digest, directory):
+        # A temp file in directory with the blob's contents, or None if
+        # the store has no usable blob
+        if not blob_store or not self.digest_pattern.match(digest):
+            return None
+        blob = self.path(digest)
+        if not self.valid(blob):
+            if os.path.exists(blob + ".meta"):
+                self.discard(blob)
+            return None
+        temp = os.path.join(directory, upload_prefix + uuid.uuid4().hex)
+        try:
+            if not clone_file(blob, temp):
+                return None
+        except FileNotFoundError:
+            return None
+        self.count(os.stat(temp).st_size, stored=False, instant=True)
+        return temp
+
+    def commit(self, temp, digest):
+        # Called with a complete upload before it is renamed into place.
+        # Returns the path to rename: temp, now also in the store, or a
+        # link to the blob that was already there, temp being removed
+        if not blob_store:
+            return temp
+        size = os.stat(temp).st_size
+        blob = self.path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            stored = clone_file(temp, blob)
+        except FileExistsError:
+            if not self.valid(blob):
+                # Changed since it was stored, or still being sealed
+                if os.path.exists(blob + ".meta"):
+                    self.discard(blob)
+                return temp
+            linked = os.path.join(
+                os.path.dirname(temp), upload_prefix + uuid.uuid4().hex
+            )
+            if not clone_file(blob, linked):
+                return temp
+            os.unlink(temp)
+            self.count(size, stored=False)
+            return linked
+        except OSError:
+            # Most likely another filesystem: keep the upload as it is
+            return temp
+        if stored:
+            self.seal(blob)
+            self.count(size, stored=True)
+        return temp
+
+    def count(self, size, stored, instant=False):
+        with self.lock:
+            self.files += 1
+            self.instant += instant
+            self.logical_bytes += size
+            if stored:
+                self.stored_bytes += size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files": self.files,
+                "instant": self.instant,
+                "logical_bytes": self.logical_bytes,
+                "stored_bytes": self.stored_bytes,
+                "bytes_saved": self.logical_bytes - self.stored_bytes,
+                "dedup_ratio": self.stored_bytes
+                and self.logical_bytes / self.stored_bytes,
+            }
+
+
+blobs = BlobStore()
+
+
+# Digest header algorithms (RFC 3230) checked on raw uploads
+digest_algorithms = {
+    "md5": "md5",
+    "sha": "sha1",
+    "sha-256": "sha256",
+    "sha-512": "sha512",
+}
+
+
+def expected_digests(headers):
+    # {hashlib name: digest bytes} from Digest and Content-MD5. Unknown
+    # algorithms are skipped; a malformed value raises ValueError
+    expected = {}
+    for value in headers.get("Digest", "").split(","):
+        algorithm, _, digest = value.strip().partition("=")
+        algorithm = digest_algorithms.get(algorithm.lower())
+        if algorithm is not None:
+            expected[algorithm] = base64.b64decode(digest, validate=True)
+    if "Content-MD5" in headers:
+        expected["md5"] = base64.b64decode(
+            headers["Content-MD5"], validate=True
+        )
+    return expected
+
+
+def write_upload(directory, stream, length, hashes):
+    # Copies up to length bytes of the body into a temp file in directory
+    # in chunk_size pieces, feeding every hash on the way. Returns the temp
+    # path and the number of bytes written
+    path = os.path.join(directory, upload_prefix + uuid.uuid4().hex)
+    written = 0
+    try:
+        with open(path, "xb") as fd:
+            while written < length:
+                chunk = stream.read(min(chunk_size, length - written))
+                if not chunk:
+                    break
+                fd.write(chunk)
+                for h in hashes:
+                    h.update(chunk)
+                written += len(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, written
+
+
+class TreeWalker:
+    # Walks depth-first in name order while a shared thread pool reads and
+    # stats directories ahead of the walk. Results are consumed in walk
+    # order, so the output does not depend on the pool size
+    pools = {}
+    pools_lock = threading.Lock()
+
+    def __init__(self):
+        self.pending = {}
+        self.pool = None
+        if walk_workers > 1:
+            with TreeWalker.pools_lock:
+                if walk_workers not in TreeWalker.pools:
+                    TreeWalker.pools[walk_workers] = ThreadPoolExecutor(
+                        walk_workers
+                    )
+                self.pool = TreeWalker.pools[walk_workers]
+
+    def read(self, path):
+        listing = watcher.listing(path) if watcher else None
+        if listing is not None:
+            files = listing.files
+        else:
+            files = list(iter_files(path))
+        files = [file for file in files if not file.ignored()]
+        for file in files:
+            file.stat
+        return sorted(files, key=operator.attrgetter("name"))
+
+    def listing(self, path):
+        future = self.pending.pop(path, None)
+        if future is not None:
+            return future.result()
+        return self.read(path)
+
+    def prefetch(self, paths):
+        for path in paths:
+            if len(self.pending) >= walk_queue_depth:
+                break
+            if path not in self.pending:
+                self.pending[path] = self.pool.submit(self.read, path)
+
+    def walk(self, path, after=(), ancestors=None):
+        if ancestors is None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            ancestors = {(st.st_dev, st.st_ino)}
+        try:
+            files = self.listing(path)
+        except OSError:
+            return
+
+        subdirs = [
+            file.path
+            for file in files
+            if file.type == "dir"
+            and (not after or file.name >= after[0])
+            and (walk_follow_symlinks or not file.is_symlink())
+        ]
+        if self.pool is not None:
+            self.prefetch(subdirs)
+        subdirs = set(subdirs)
+
+        for file in files:
+            resume = ()
+            if after and file.name <= after[0]:
+                if file.name < after[0] or len(after) == 1:
+                    continue
+                if file.type != "dir":
+                    continue
+                resume = after[1:]
+            if file.type != "dir":
+                yield file
+            elif file.path in subdirs:
+                # A symlink back to a directory being walked is a loop
+                inode = file.stat and (file.stat.st_dev, file.stat.st_ino)
+                if not inode or inode in ancestors:
+                    continue
+                ancestors.add(inode)
+                for subfile in self.walk(file.path, resume, ancestors):
+                    yield subfile
+                ancestors.discard(inode)
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+
+
+def iter_recursive_files(path, after=()):
+    # Depth-first in name order, skipping ignored directories, so a walk
+    # can resume right after a relative path given as a tuple of names.
+    # Directories the watcher has indexed are read from memory
+    walker = TreeWalker()
+    try:
+        for file in walker.walk(path, after):
+            yield file
+    finally:
+        walker.close()
 
 
 def iter_files(path):
-    for filename in os.listdir(path):
-        yield File(os.path.join(path, filename), path)
+    with os.scandir(path) as it:
+        for entry in it:
+            yield File(entry.path, path, entry)
 
 
-def sorted_contents(contents, sorting):
+def encode_cursor(value):
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(data.decode("utf-8"))
+    except (ValueError, TypeError):
+        return None
+
+
+def recursive_page(path, hide_dotfile, sorting, page, page_size, after):
+    # Memory stays bounded by the page: unsorted pages stop walking once
+    # they are full, sorted ones keep a heap of page_size rows (or of the
+    # rows up to the page when paging by number)
+    if sorting and sorting.lstrip("-") not in sort_keys:
+        sorting = None
+    prefix = len(os.path.join(path, ""))
+    files = (
+        file
+        for file in iter_recursive_files(path, () if sorting else after)
+        if not (hide_dotfile and file.hidden()) and file.stat
+    )
+
     if not sorting:
-        return contents
-    reverse = sorting.startswith("-")
+        start = 0 if after else page * page_size
+        contents = list(itertools.islice(files, start, start + page_size))
+        cursor = None
+        if len(contents) == page_size:
+            last = contents[-1].path[prefix:].split(os.sep)
+            cursor = encode_cursor(["", last])
+        return contents, None, cursor
+
+    total = {"size": 0, "dir": 0, "file": 0}
     key = sorting.lstrip("-")
-    return sorted(
-        contents, reverse=reverse, key=lambda f: getattr(f, key, None)
+    reverse = sorting.startswith("-")
+
+    def value(file):
+        return (getattr(file, key), file.path[prefix:])
+
+    def counted(files):
+        for file in files:
+            total[file.type] += 1
+            total["size"] += file.size
+            yield file
+
+    rows = counted(files)
+    count = (page + 1) * page_size
+    if after and not (
+        len(after) == 2
+        and isinstance(after[0], str if key in ("name", "type") else number)
+        and not isinstance(after[0], bool)
+        and isinstance(after[1], str)
+    ):
+        after = None
+    if after:
+        rows = (
+            file
+            for file in rows
+            if (value(file) < after if reverse else value(file) > after)
+        )
+        count = page_size
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    contents = select(count, rows, key=value)
+    offset = count - page_size
+    contents = contents[offset:]
+    cursor = None
+    if len(contents) == page_size:
+        cursor = encode_cursor([sorting, list(value(contents[-1]))])
+    return contents, total, cursor
+
+
+listing_formats = {
+    "text/html": "html",
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/x-msgpack": "msgpack",
+}
+
+
+def listing_columns(path, files):
+    # One array per attribute instead of one object per row; names are
+    # relative to the listed directory so recursive rows stay unique
+    prefix = len(os.path.join(path, ""))
+    columns = {"name": [], "type": [], "size": [], "mtime": []}
+    for file in files:
+        columns["name"].append(file.path[prefix:])
+        columns["type"].append(file.type)
+        columns["size"].append(file.size)
+        columns["mtime"].append(file.mtime)
+    return columns
+
+
+def listing_response(fmt, p, path, contents, total, cursor):
+    data = {
+        "path": "/" + p.strip("/"),
+        "columns": listing_columns(path, contents),
+        "total": total,
+        "next": cursor,
+    }
+    if fmt == "msgpack":
+        return Response(
+            msgpack.packb(data, use_bin_type=True),
+            mimetype="application/x-msgpack",
+        )
+    return Response(
+        json.dumps(data, separators=(",", ":")), mimetype="application/json"
     )
 
 
-def paginate(contents, page, page_size=100):
+@app.context_processor
+def template_globals():
+    return {"api_prefix": api_prefix}
+
+
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(100)
+    return stream
+
+
+def gzip_chunks(chunks, sync=True):
+    # Each chunk is sync-flushed so the client can render it right away
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if sync:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def streamed_response(chunks, mimetype):
+    chunks = stream_with_context(chunks)
+    if not (compress_listings and request.accept_encodings["gzip"]):
+        response = Response(chunks, mimetype=mimetype)
+    else:
+        response = Response(gzip_chunks(chunks), mimetype=mimetype)
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def listing_etag(st, params):
+    # Weak: renaming, adding or removing entries bumps the directory's
+    # mtime, rewriting a file inside it does not, so the tag also rolls
+    # over with the listing cache TTL
+    epoch = int(time.time() // listing_cache_ttl) if listing_cache_ttl else 0
+    digest = zlib.crc32(json.dumps(params).encode("utf-8"))
+    return "{0:x}-{1:x}-{2:x}-{3:08x}".format(
+        st.st_ino, st.st_mtime_ns, epoch, digest
+    )
+
+
+def listing_headers(response, hide_dotfile):
+    response.vary.update(("Cookie", "Accept", "Accept-Encoding"))
+    if request.cookies.get("hide-dotfile") != hide_dotfile:
+        response.set_cookie("hide-dotfile", hide_dotfile, max_age=16070400)
+    return response
+
+
+def iter_archive_files(path, hide_dotfile):
+    # (name in the archive, File) for every regular file under path, with
+    # the listing's filtering; hidden directories are skipped as a whole
+    top = os.path.basename(path) or "files"
+    prefix = len(os.path.join(path, ""))
+    for file in iter_recursive_files(path):
+        rel = file.path[prefix:].replace(os.sep, "/")
+        if hide_dotfile and any(
+            part.startswith(".") for part in rel.split("/")
+        ):
+            continue
+        if file.stat and stat.S_ISREG(file.stat.st_mode):
+            yield top + "/" + rel, file
+
+
+class ArchiveSink:
+    # Unseekable target for zipfile: whatever it writes is handed to the
+    # response as soon as it can be, instead of being kept
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_date_time(mtime):
+    # ZIP dates start in 1980
+    return max(time.localtime(mtime)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def iter_member_data(path, start, length):
+    # Archive headers announce the size found by the walk: a file that
+    # shrank, went away or can no longer be read since is zero-padded to
+    # it instead of cutting the archive short
     try:
-        page = int(page)
-        page_size = int(page_size)
-    except Exception:
-        return contents
-    start = page * page_size
-    end = start + page_size
-    return contents[start:end]
+        for chunk in iter_file_range(path, start, length):
+            length -= len(chunk)
+            yield chunk
+    except OSError:
+        pass
+    while length > 0:
+        chunk = tarfile.NUL * min(chunk_size, length)
+        length -= len(chunk)
+        yield chunk
+
+
+def iter_zip(files):
+    # Without a seekable output zipfile writes a data descriptor after each
+    # member, and switches to ZIP64 records where sizes or counts need it
+    sink = ArchiveSink()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for name, file in files:
+            st = file.stat
+            info = zipfile.ZipInfo(name, zip_date_time(st.st_mtime))
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            info.file_size = st.st_size
+            info.compress_type = zipfile.ZIP_DEFLATED
+            if data_fmt(file.name) in compressed_datatypes:
+                info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, "w") as member:
+                for chunk in iter_member_data(file.path, 0, st.st_size):
+                    member.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_tar(files):
+    for name, file in files:
+        st = file.stat
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        # PAX headers carry long names and sizes over 8 GiB
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        for chunk in iter_member_data(file.path, 0, st.st_size):
+            yield chunk
+        padding = -st.st_size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+
+crcs = collections.OrderedDict()
+crcs_lock = threading.Lock()
+
+
+class ZipMember:
+    def __init__(self, name, file, offset):
+        st = file.stat
+        self.path = file.path
+        self.stat = st
+        self.size = st.st_size
+        self.offset = offset
+        self.crc = None
+        self.mode = st.st_mode
+        try:
+            self.name = name.encode("ascii")
+            self.flags = 0x08
+        except UnicodeEncodeError:
+            self.name = name.encode("utf-8")
+            self.flags = 0x08 | 0x800
+        date_time = zip_date_time(st.st_mtime)
+        self.time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+        self.date = (date_time[0] - 1980) << 9 | date_time[1] << 5
+        self.date |= date_time[2]
+        # Same thresholds as zipfile, so both write alike archives
+        self.zip64 = self.size > zipfile.ZIP64_LIMIT
+        self.version = 45 if self.zip64 else 20
+
+    def key(self):
+        st = self.stat
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def crc_path(self):
+        st = self.stat
+        name = "{0}-{1}".format(st.st_dev, st.st_ino)
+        return os.path.join(
+            crc_store, "{0:02x}".format(st.st_ino & 0xFF), name
+        )
+
+    def load_crc(self):
+        with crcs_lock:
+            self.crc = crcs.get(self.key())
+        if self.crc is not None or not crc_store:
+            return
+        try:
+            with open(self.crc_path()) as fd:
+                size, mtime_ns, crc = fd.read().split()
+        except (OSError, ValueError):
+            return
+        if [size, mtime_ns] == [str(self.size), str(self.stat.st_mtime_ns)]:
+            self.crc = int(crc, 16)
+
+    def store_crc(self, crc):
+        self.crc = crc
+        with crcs_lock:
+            crcs[self.key()] = crc
+            while len(crcs) > crc_cache_size:
+                crcs.popitem(last=False)
+        if not crc_store:
+            return
+        # Keyed by inode, so a changed file overwrites its stale entry
+        path = self.crc_path()
+        temp = "{0}.{1}".format(path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, "w") as fd:
+                fd.write(
+                    "{0} {1} {2:08x}".format(
+                        self.size, self.stat.st_mtime_ns, crc
+                    )
+                )
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+    def local_header(self):
+        # Sizes and CRC follow the data, in a data descriptor
+        size = 0xFFFFFFFF if self.zip64 else 0
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if self.zip64 else b""
+        header = struct.pack(
+            zipfile.structFileHeader,
+            zipfile.stringFileHeader,
+            self.version,
+            0,
+            self.flags,
+            zipfile.ZIP_STORED,
+            self.time,
+            self.date,
+            0,
+            size,
+            size,
+            len(self.name),
+            len(extra),
+        )
+        return header + self.name + extra
+
+    def descriptor_size(self):
+        return 24 if self.zip64 else 16
+
+    def descriptor(self):
+        fmt = "<4sLQQ" if self.zip64 else "<4sLLL"
+        return struct.pack(fmt, b"PK\x07\x08", self.crc, self.size, self.size)
+
+    def central_extra(self):
+        fields = []
+        if self.zip64:
+            fields += [self.size, self.size]
+        if self.offset > zipfile.ZIP64_LIMIT:
+            fields.append(self.offset)
+        if not fields:
+            return b""
+        return struct.pack(
+            "<HH" + "Q" * len(fields), 1, 8 * len(fields), *fields
+        )
+
+    def central_size(self):
+        return zipfile.sizeCentralDir + len(self.name + self.central_extra())
+
+    def central_header(self):
+        extra = self.central_extra()
+        version = 45 if extra else self.version
+        size = 0xFFFFFFFF if self.zip64 else self.size
+        offset = self.offset
+        if offset > zipfile.ZIP64_LIMIT:
+            offset = 0xFFFFFFFF
+        header = struct.pack(
+            zipfile.structCentralDir,
+            zipfile.stringCentralDir,
+            version,
+            3,
+            version,
+            0,
+            self.flags,
+            zipfile.ZIP_STORED,
+            self.time,
+            self.date,
+            self.crc,
+            size,
+            size,
+            len(self.name),
+            len(extra),
+            0,
+            0,
+            0,
+            (self.mode & 0xFFFF) << 16,
+            offset,
+        )
+        return header + self.name + extra
+
+
+class StoredZip:
+    # A ZIP without compression whose layout follows from stat data alone:
+    # its length is known up front and any byte range can be produced, so
+    # the download can be resumed like a plain file. CRCs are computed as
+    # file data goes out, or by reading the file when a range starts past
+    # it, and cached across requests
+    def __init__(self, files):
+        self.members = []
+        self.offsets = []
+        self.segments = []
+        self.length = 0
+        for name, file in files:
+            member = ZipMember(name, file, self.length)
+            self.members.append(member)
+            self.add("header", member, len(member.local_header()))
+            self.add("data", member, member.size)
+            self.add("descriptor", member, member.descriptor_size())
+        self.central_offset = self.length
+        self.central_size = sum(m.central_size() for m in self.members)
+        self.zip64 = (
+            len(self.members) >= zipfile.ZIP_FILECOUNT_LIMIT
+            or self.central_offset > zipfile.ZIP64_LIMIT
+            or self.central_size > zipfile.ZIP64_LIMIT
+        )
+        end_size = zipfile.sizeEndCentDir
+        if self.zip64:
+            end_size += zipfile.sizeEndCentDir64
+            end_size += zipfile.sizeEndCentDir64Locator
+        self.add("central", None, self.central_size + end_size)
+        self.central = None
+
+    def add(self, kind, member, size):
+        self.offsets.append(self.length)
+        self.segments.append((kind, member, size))
+        self.length += size
+
+    def etag(self):
+        layout = [
+            [m.name.decode("utf-8"), m.key(), m.time, m.date, m.mode]
+            for m in self.members
+        ]
+        data = json.dumps(layout).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()[:32]
+
+    def last_modified(self):
+        mtime = max((m.stat.st_mtime for m in self.members), default=0)
+        return datetime.utcfromtimestamp(int(mtime))
+
+    def read(self, start, length):
+        end = start + length
+        i = bisect.bisect_right(self.offsets, start) - 1
+        while start < end:
+            kind, member, size = self.segments[i]
+            skip = start - self.offsets[i]
+            take = min(size - skip, end - start)
+            if kind == "data":
+                chunks = self.read_data(member, skip, take)
+            else:
+                if kind == "header":
+                    data = member.local_header()
+                elif kind == "descriptor":
+                    self.compute_crc(member)
+                    data = member.descriptor()
+                else:
+                    data = self.central_directory()
+                stop = skip + take
+                chunks = [data[skip:stop]]
+            for chunk in chunks:
+                yield chunk
+            start += take
+            i += 1
+
+    def read_data(self, member, skip, take):
+        crc = 0 if skip == 0 and take == member.size else None
+        for chunk in iter_member_data(member.path, skip, take):
+            if crc is not None:
+                crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if crc is not None and member.crc is None:
+            member.store_crc(crc)
+
+    def compute_crc(self, member):
+        if member.crc is None:
+            member.load_crc()
+        if member.crc is None:
+            for chunk in self.read_data(member, 0, member.size):
+                pass
+
+    def central_directory(self):
+        if self.central is not None:
+            return self.central
+        headers = []
+        for member in self.members:
+            self.compute_crc(member)
+            headers.append(member.central_header())
+        count = len(self.members)
+        offset = self.central_offset
+        size = self.central_size
+        if self.zip64:
+            headers.append(
+                struct.pack(
+                    zipfile.structEndArchive64,
+                    zipfile.stringEndArchive64,
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    size,
+                    offset,
+                )
+            )
+            headers.append(
+                struct.pack(
+                    zipfile.structEndArchive64Locator,
+                    zipfile.stringEndArchive64Locator,
+                    0,
+                    offset + size,
+                    1,
+                )
+            )
+            count = min(count, 0xFFFF)
+            size = min(size, 0xFFFFFFFF)
+            offset = min(offset, 0xFFFFFFFF)
+        headers.append(
+            struct.pack(
+                zipfile.structEndArchive,
+                zipfile.stringEndArchive,
+                0,
+                0,
+                count,
+                count,
+                size,
+                offset,
+                0,
+            )
+        )
+        self.central = b"".join(headers)
+        return self.central
+
+
+archive_formats = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+}
+
+
+def archive_response(path, fmt, compression, hide_dotfile):
+    files = iter_archive_files(path, hide_dotfile)
+    if fmt == "zip" and compression == "store":
+        archive = StoredZip(files)
+        response = ranged_response(
+            archive.read,
+            archive.length,
+            archive_formats[fmt],
+            archive.etag(),
+            archive.last_modified(),
+        )
+    else:
+        if fmt == "zip":
+            chunks = iter_zip(files)
+        elif fmt == "tar":
+            chunks = iter_tar(files)
+        else:
+            chunks = gzip_chunks(iter_tar(files), sync=False)
+        response = Response(chunks, mimetype=archive_formats[fmt])
+    name = "{0}.{1}".format(os.path.basename(path) or "files", fmt)
+    response.headers["Content-Disposition"] = (
+        "attachment; filename=\"{0}\"; filename*=UTF-8''{1}".format(
+            secure_filename(name) or "archive." + fmt, quote(name)
+        )
+    )
+    return response
+
+
+def iter_ndjson(path, files):
+    prefix = len(os.path.join(path, ""))
+    yield json.dumps(["name", "type", "size", "mtime"]) + "\n"
+    for file in files:
+        row = [file.path[prefix:], file.type, file.size, file.mtime]
+        yield json.dumps(row, separators=(",", ":")) + "\n"
+
+
+sort_keys = ("name", "size", "mtime", "type")
+number = (int, float)
+
+
+def sort_value(file, key):
+    # Ties on the sort key are broken by name, so each row has a unique
+    # position a cursor can point at
+    return (getattr(file, key), file.name)
+
+
+@functools.lru_cache(maxsize=4096)
+def dir_url(path, base):
+    # Rows of a listing share their directory, so only names get quoted
+    rel = os.path.relpath(path, base)
+    if rel == ".":
+        return "/"
+    return quote("/" + rel.replace(os.sep, "/") + "/")
+
+
+def ignored_name(name):
+    return name in ignored or name.startswith(upload_prefix)
 
 
 class File:
-    def __init__(self, full_path, base_path):
+    def __init__(self, full_path, base_path, entry=None):
         self.path = full_path
         self.name = os.path.basename(self.path)
+        self.entry = entry
 
     def get_absolute_url(self):
-        f = furl.furl(os.path.relpath(self.path, root))
-        f.path.isabsolute = True
-        return f.url
+        return dir_url(os.path.dirname(self.path), root) + quote(self.name)
 
     @cached_property
     def stat(self):
         try:
+            if self.entry is not None:
+                return self.entry.stat()
             return os.stat(self.path)
         except Exception:
             try:
@@ -208,7 +1532,12 @@ class File:
 
     @cached_property
     def type(self):
-        if self.stat.st_mode and (
+        if self.entry is not None:
+            try:
+                return "dir" if self.entry.is_dir() else "file"
+            except OSError:
+                pass
+        if self.stat and (
             stat.S_ISDIR(self.stat.st_mode) or stat.S_ISLNK(self.stat.st_mode)
         ):
             return "dir"
@@ -222,26 +1551,428 @@ class File:
     def size(self):
         return self.stat and self.stat.st_size
 
+    def is_symlink(self):
+        if self.entry is not None:
+            return self.entry.is_symlink()
+        return os.path.islink(self.path)
+
     def ignored(self):
-        return self.name in ignored
+        return ignored_name(self.name)
 
     def hidden(self):
         return self.name.startswith(".")
 
 
+class Listing:
+    def __init__(self, files):
+        self.files = [file for file in files if not file.ignored()]
+        self.memo = {}
+        self.created = time.time()
+
+    def filtered(self, hide_dotfile, with_stat=True):
+        key = ("filtered", hide_dotfile, with_stat)
+        if key not in self.memo:
+            files = self.files
+            if hide_dotfile:
+                files = [file for file in files if not file.hidden()]
+            if with_stat:
+                files = [file for file in files if file.stat]
+            self.memo[key] = files
+        return self.memo[key]
+
+    def totals(self, hide_dotfile, with_size=True):
+        key = ("totals", hide_dotfile, with_size)
+        if key not in self.memo:
+            total = {"size": 0 if with_size else None, "dir": 0, "file": 0}
+            for file in self.filtered(hide_dotfile, with_size):
+                total[file.type] += 1
+                if with_size:
+                    total["size"] += file.size
+            self.memo[key] = total
+        return self.memo[key]
+
+    def sorted(self, hide_dotfile, key, with_stat=True):
+        memo = ("sorted", hide_dotfile, key, with_stat)
+        if memo not in self.memo:
+            files = sorted(
+                self.filtered(hide_dotfile, with_stat),
+                key=lambda file: sort_value(file, key),
+            )
+            keys = [sort_value(file, key) for file in files]
+            self.memo[memo] = files, keys
+        return self.memo[memo]
+
+    def updated(self, names, files):
+        # A copy with the entries called names replaced by files (those of
+        # them that still exist). Sort orders are patched rather than
+        # redone; the rest of the memo is linear to rebuild
+        files = [file for file in files if not file.ignored()]
+        removed = [file for file in self.files if file.name in names]
+        listing = Listing(
+            [file for file in self.files if file.name not in names] + files
+        )
+        # Request threads keep adding to the memo meanwhile
+        for memo, value in list(self.memo.items()):
+            if memo[0] != "sorted":
+                continue
+            _, hide_dotfile, key, with_stat = memo
+            rows, keys = list(value[0]), list(value[1])
+            for file in removed:
+                i = bisect.bisect_left(keys, sort_value(file, key))
+                if i < len(rows) and rows[i] is file:
+                    del rows[i], keys[i]
+            for file in files:
+                if hide_dotfile and file.hidden():
+                    continue
+                if with_stat and not file.stat:
+                    continue
+                value = sort_value(file, key)
+                i = bisect.bisect_right(keys, value)
+                rows.insert(i, file)
+                keys.insert(i, value)
+            listing.memo[memo] = rows, keys
+        return listing
+
+    def page(self, hide_dotfile, sorting, page, page_size, after=None):
+        # Names and types come from the directory itself, so in lazy mode
+        # only the rows on the page are stat'ed and the size total is
+        # skipped. Unsorted listings are ordered by name
+        key = (sorting or "").lstrip("-")
+        reverse = (sorting or "").startswith("-")
+        if key not in sort_keys:
+            key, reverse = "name", False
+        lazy = lazy_stat and key == "name"
+        files, keys = self.sorted(hide_dotfile, key, not lazy)
+
+        # Rows are kept ascending; descending pages are read backwards
+        try:
+            if after is None:
+                position = len(files) - page * page_size
+                start = page * page_size
+            elif reverse:
+                position = bisect.bisect_left(keys, after)
+            else:
+                start = bisect.bisect_right(keys, after)
+        except TypeError:
+            return self.page(hide_dotfile, sorting, page, page_size)
+        if reverse:
+            end = max(position, 0)
+            start = max(end - page_size, 0)
+            contents = files[start:end][::-1]
+            more = start > 0
+        else:
+            end = start + page_size
+            contents = files[start:end]
+            more = end < len(files)
+
+        cursor = None
+        if contents and more:
+            last = keys[start] if reverse else keys[end - 1]
+            cursor = encode_cursor([sorting or "", list(last)])
+        if lazy:
+            contents = [file for file in contents if file.stat]
+        return contents, self.totals(hide_dotfile, not lazy), cursor
+
+
+class ListingCache:
+    def __init__(self):
+        self.listings = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.files = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, st=None):
+        if st is None:
+            st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_ino)
+        with self.lock:
+            listing = self.listings.get(path)
+            if (
+                listing is not None
+                and listing.key == key
+                and time.time() - listing.created < listing_cache_ttl
+            ):
+                self.listings.move_to_end(path)
+                self.hits += 1
+                return listing
+            self.misses += 1
+
+        listing = Listing(iter_files(path))
+        listing.key = key
+        with self.lock:
+            self.discard(path)
+            if len(listing.files) <= listing_cache_files:
+                self.listings[path] = listing
+                self.files += len(listing.files)
+            while self.listings and (
+                len(self.listings) > listing_cache_size
+                or self.files > listing_cache_files
+            ):
+                self.discard(next(iter(self.listings)))
+        return listing
+
+    def discard(self, path):
+        listing = self.listings.pop(path, None)
+        if listing is not None:
+            self.files -= len(listing.files)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "listings": len(self.listings),
+            "files": self.files,
+        }
+
+
+listing_cache = ListingCache()
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+inotify_event = struct.Struct("iIII")
+
+
+class Watcher:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.watches = {}
+        self.listings = {}
+        self.generations = {}
+        self.epoch = 0
+        self.unwatchable = set()
+        self.exhausted = False
+        self.hits = 0
+
+    def start(self):
+        threading.Thread(target=self.read_events, daemon=True).start()
+        threading.Thread(target=self.index_tree, daemon=True).start()
+
+    def index_tree(self):
+        for file in iter_recursive_files(root):
+            pass
+
+    def listing(self, path):
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None:
+                self.hits += 1
+                return listing
+            if path in self.unwatchable:
+                return None
+            wd = self.watches.get(path)
+        if wd is None:
+            wd = self.watch(path)
+            if wd is None:
+                return None
+        with self.lock:
+            generation = (self.epoch, self.generations.get(wd))
+
+        # Watch before scanning; events arriving during the scan make
+        # the result unusable and the next request scans again
+        try:
+            listing = Listing(iter_files(path))
+        except OSError:
+            return None
+        with self.lock:
+            if self.watches.get(path) == wd and generation == (
+                self.epoch,
+                self.generations.get(wd),
+            ):
+                self.listings[path] = listing
+        return listing
+
+    def watch(self, path):
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(path), IN_WATCH_MASK
+        )
+        with self.lock:
+            if wd < 0:
+                if ctypes.get_errno() == errno.ENOSPC:
+                    self.exhausted = True
+                self.unwatchable.add(path)
+                return None
+            if self.paths.setdefault(wd, path) != path:
+                # Same directory reached through another path
+                self.unwatchable.add(path)
+                return None
+            self.watches[path] = wd
+        return wd
+
+    def forget(self, path):
+        # Called with the lock held; drops path and everything below it
+        prefix = os.path.join(path, "")
+        for watched in list(self.watches):
+            if watched == path or watched.startswith(prefix):
+                wd = self.watches.pop(watched)
+                self.paths.pop(wd, None)
+                self.generations.pop(wd, None)
+                self.listings.pop(watched, None)
+                self.libc.inotify_rm_watch(self.fd, wd)
+        # Freed watches may let previously unwatchable directories in
+        self.unwatchable.clear()
+        self.exhausted = False
+
+    def read_events(self):
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            events = []
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = inotify_event.unpack_from(
+                    data, offset
+                )
+                start = offset + inotify_event.size
+                offset = start + length
+                name = os.fsdecode(data[start:offset].rstrip(b"\0"))
+                events.append((wd, mask, name))
+            try:
+                self.apply(events)
+            except Exception:
+                # As on a queue overflow: rescanning beats serving
+                # listings that missed these events
+                app.logger.exception("Could not apply inotify events")
+                with self.lock:
+                    self.epoch += 1
+                    self.listings.clear()
+
+    def apply(self, events):
+        changed = collections.defaultdict(set)
+        with self.lock:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    self.epoch += 1
+                    self.listings.clear()
+                    changed.clear()
+                    continue
+                path = self.paths.get(wd)
+                if path is None or ignored_name(name):
+                    # Upload temp files come and go without showing
+                    continue
+                self.generations[wd] = self.generations.get(wd, 0) + 1
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.forget(path)
+                    continue
+                if mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.forget(os.path.join(path, name))
+                changed[path].add(name)
+                missing_paths.discard(os.path.join(path, name))
+
+        # Whatever the event, the entry is re-stat'ed: it exists or not
+        for path, names in changed.items():
+            with self.lock:
+                listing = self.listings.get(path)
+            if listing is None:
+                continue
+            files = [File(os.path.join(path, name), path) for name in names]
+            updated = listing.updated(
+                names, [file for file in files if file.stat]
+            )
+            with self.lock:
+                if self.listings.get(path) is listing:
+                    self.listings[path] = updated
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "watches": len(self.watches),
+            "listings": len(self.listings),
+            "unwatchable": len(self.unwatchable),
+            "exhausted": self.exhausted,
+        }
+
+
+watcher = None
+
+
+@app.before_first_request
+def start_watcher():
+    global watcher
+    if watch_root and watcher is None:
+        try:
+            watcher = Watcher()
+        except (OSError, AttributeError) as e:
+            app.logger.warning("inotify unavailable, not watching: %s", e)
+        else:
+            watcher.start()
+
+
+def get_listing(path, st=None):
+    if watcher is not None:
+        listing = watcher.listing(path)
+        if listing is not None:
+            return listing
+    return listing_cache.get(path, st)
+
+
 class PathView(MethodView):
     def get_page(self):
         try:
-            return int(request.args.get("page"))
+            return max(int(request.args.get("page")), 0)
         except (ValueError, TypeError):
             return 0
 
     def get_page_size(self):
         try:
-            return int(request.args.get("page_size"))
+            return max(int(request.args.get("page_size")), 1)
         except (ValueError, TypeError):
             return 100
 
+    def get_format(self):
+        fmt = request.args.get("format")
+        if fmt not in listing_formats.values():
+            fmt = listing_formats[
+                request.accept_mimetypes.best_match(
+                    list(listing_formats), "text/html"
+                )
+            ]
+        if fmt == "msgpack" and msgpack is None:
+            return "json"
+        return fmt
+
+    def get_after(self, sorting):
+        # The cursor is [sorting, sort key of the last row shown]; it is
+        # ignored once the user picks another sorting. Unsorted keys are
+        # names only (a path, in recursive listings)
+        cursor = decode_cursor(request.args.get("after", ""))
+        if (
+            isinstance(cursor, list)
+            and len(cursor) == 2
+            and cursor[0] == (sorting or "")
+            and isinstance(cursor[1], list)
+            and (sorting or all(isinstance(name, str) for name in cursor[1]))
+        ):
+            return tuple(cursor[1])
+        return None
+
     def get(self, p=""):
         hide_dotfile = request.args.get(
             "hide-dotfile", request.cookies.get("hide-dotfile", "no")
@@ -249,69 +1980,150 @@ class PathView(MethodView):
 
         recursive = request.args.get("recursive") == "yes"
         sorting = request.args.get("sorting")
+        # Unknown sortings list unsorted, and cursors must say so
+        if sorting and sorting.lstrip("-") not in sort_keys:
+            sorting = None
 
-        path = os.path.join(root, p)
-        if os.path.isdir(path):
-            contents = []
-            total = {"size": 0, "dir": 0, "file": 0}
+        target = resolve(p)
+        is_dir = target is not None and target.type == "dir"
+        etag = None
+        archive = request.args.get("archive")
+        if archive not in archive_formats:
+            archive = None
+        if is_dir and not recursive and not archive:
+            # Recursive listings depend on the whole subtree, so only plain
+            # directory listings get a validator
+            etag = listing_etag(
+                target.stat,
+                [
+                    hide_dotfile,
+                    sorting,
+                    self.get_page(),
+                    self.get_page_size(),
+                    request.args.get("after"),
+                    self.get_format(),
+                ],
+            )
+        path = target.path if target else None
+        if target is None:
+            res = make_response("Not found", 404)
+        elif etag is not None and request.if_none_match.contains_weak(etag):
+            res = Response(status=304)
+        elif is_dir and archive:
+            res = archive_response(
+                path,
+                archive,
+                request.args.get("compression", "auto"),
+                hide_dotfile == "yes",
+            )
+        elif is_dir and self.get_format() == "ndjson":
+            # Every row, streamed in name order straight from the walk
             if recursive:
-                iterator = iter_recursive_files(path)
+                files = iter_recursive_files(path)
             else:
-                iterator = iter_files(path)
-            for file in iterator:
-                if file.ignored():
-                    continue
-                if hide_dotfile == "yes" and file.hidden():
-                    continue
-                if not file.stat:
-                    continue
-                total[file.type] += 1
-                total["size"] += file.size
-
-                contents.append(file)
-
-            contents = sorted_contents(contents, sorting)
-            contents = paginate(
-                contents, self.get_page(), page_size=self.get_page_size()
+                files = get_listing(path, target.stat).sorted(
+                    hide_dotfile == "yes", "name"
+                )[0]
+            files = (
+                file
+                for file in files
+                if not (hide_dotfile == "yes" and file.hidden()) and file.stat
             )
-            response_content = render_template(
-                "index.html",
-                path=p,
-                page=self.get_page(),
-                page_size=self.get_page_size(),
-                contents=contents,
-                total=total,
-                hide_dotfile=hide_dotfile,
-                recursive=recursive,
+            res = streamed_response(
+                iter_ndjson(path, files), "application/x-ndjson"
             )
-            res = make_response(response_content, 200)
-            res.set_cookie("hide-dotfile", hide_dotfile, max_age=16070400)
-        elif os.path.isfile(path):
-            if "Range" in request.headers:
-
-                start, end = get_range(request)
-                res = partial_response(path, start, end)
+        elif is_dir:
+            cursor = None
+            if recursive:
+                contents, total, cursor = recursive_page(
+                    path,
+                    hide_dotfile == "yes",
+                    sorting,
+                    self.get_page(),
+                    self.get_page_size(),
+                    self.get_after(sorting),
+                )
+            else:
+                listing = get_listing(path, target.stat)
+                contents, total, cursor = listing.page(
+                    hide_dotfile == "yes",
+                    sorting,
+                    self.get_page(),
+                    self.get_page_size(),
+                    self.get_after(sorting),
+                )
+            fmt = self.get_format()
+            if fmt in ("json", "msgpack"):
+                res = listing_response(fmt, p, path, contents, total, cursor)
             else:
-                res = send_file(path)
+                response_content = stream_template(
+                    "index.html",
+                    path=p,
+                    page=self.get_page(),
+                    page_size=self.get_page_size(),
+                    contents=contents,
+                    total=total,
+                    after=request.args.get("after"),
+                    cursor=cursor,
+                    hide_dotfile=hide_dotfile,
+                    recursive=recursive,
+                )
+                res = streamed_response(response_content, "text/html")
+        elif offload:
+            res = offload_response(path, target.mimetype)
         else:
-            res = make_response("Not found", 404)
+            res = file_response(path, target.stat, target.mimetype)
+        if etag is not None:
+            res.set_etag(etag, weak=True)
+            res.last_modified = target.stat.st_mtime
+            res.cache_control.no_cache = True
+        if is_dir:
+            listing_headers(res, hide_dotfile)
         return res
 
     def post(self, p=""):
-        path = os.path.join(root, p)
+        target = resolve(p)
         info = {}
-        if os.path.isdir(path):
-            files = request.files.getlist("files[]")
-            for file in files:
-                try:
-                    filename = secure_filename(file.filename)
-                    file.save(os.path.join(path, filename))
-                except Exception as e:
-                    info["status"] = "error"
-                    info["msg"] = str(e)
-                else:
-                    info["status"] = "success"
-                    info["msg"] = "File Saved"
+        if target is not None and target.type == "dir":
+            if "dedup" in request.args:
+                return self.dedup(target)
+            streams = []
+            try:
+                _, _, files = parse_form_data(
+                    request.environ,
+                    stream_factory=upload_stream_factory(target.path, streams),
+                    max_form_memory_size=request.max_form_memory_size,
+                    max_content_length=request.max_content_length,
+                )
+                for file in files.getlist("files[]"):
+                    try:
+                        filename = secure_filename(file.filename)
+                        if not filename:
+                            raise ValueError("Invalid file name")
+                        filename = os.path.join(target.path, filename)
+                        file.stream.close()
+                        temp = file.stream.name
+                        if file.stream.sha256 is not None:
+                            temp = blobs.commit(
+                                temp, file.stream.sha256.hexdigest()
+                            )
+                        rename_into_place(temp, filename)
+                        missing_paths.discard(filename)
+                    except Exception as e:
+                        info["status"] = "error"
+                        info["msg"] = str(e)
+                    else:
+                        info["status"] = "success"
+                        info["msg"] = "File Saved"
+            finally:
+                # Parts that were not renamed: other fields, failed saves
+                # or an upload cut short
+                for stream in streams:
+                    stream.close()
+                    try:
+                        os.unlink(stream.name)
+                    except FileNotFoundError:
+                        pass
         else:
             info["status"] = "error"
             info["msg"] = "Invalid Operation"
@@ -319,10 +2131,404 @@ class PathView(MethodView):
         res.headers.add("Content-type", "application/json")
         return res
 
+    def dedup(self, target):
+        # Creates the file from the blob store when it already holds the
+        # client's SHA-256, so nothing has to be sent; a 404 tells the
+        # client to upload it instead
+        name = request.args.get("name", "")
+        if name in ignored or name.startswith(upload_prefix):
+            return upload_error("Forbidden", 403)
+        name = secure_filename(name)
+        if not name:
+            return upload_error("Invalid file name", 400)
+        temp = blobs.link(request.args["dedup"].lower(), target.path)
+        if temp is None:
+            return upload_error("Unknown blob", 404)
+        path = os.path.join(target.path, name)
+        rename_into_place(temp, path)
+        missing_paths.discard(path)
+        info = {"status": "success", "msg": "File Saved", "dedup": True}
+        res = make_response(json.JSONEncoder().encode(info), 200)
+        res.headers.add("Content-type", "application/json")
+        return res
+
+    def put(self, p=""):
+        # Everything that can refuse the upload is checked before the body
+        # is read, so servers that answer "Expect: 100-continue" on the
+        # first read never ask a refused client for the body
+        directory, _, name = p.rstrip("/").rpartition("/")
+        target = resolve(directory)
+        if name in ignored or name.startswith(upload_prefix):
+            return upload_error("Forbidden", 403)
+        name = secure_filename(name)
+        if target is None or target.type != "dir" or not name:
+            return upload_error("Not found", 404)
+        path = os.path.join(target.path, name)
+        if os.path.isdir(path):
+            return upload_error("A directory exists at this path", 409)
+        length = request.content_length
+        if length is None and not request.environ.get("wsgi.input_terminated"):
+            return upload_error("Length Required", 411)
+        limit = request.max_content_length
+        if limit is not None and length is not None and length > limit:
+            return upload_error("Request Entity Too Large", 413)
+        try:
+            expected = expected_digests(request.headers)
+        except ValueError:
+            return upload_error("Malformed Digest", 400)
+
+        hashes = {"sha256": hashlib.sha256()}
+        for algorithm in expected:
+            hashes.setdefault(algorithm, hashlib.new(algorithm))
+        error = None
+        if length is not None:
+            temp, written = write_upload(
+                target.path, request.stream, length, hashes.values()
+            )
+            if written < length:
+                error = ("Incomplete body", 400)
+        else:
+            # A chunked body is read one byte past the limit, if any
+            temp, written = write_upload(
+                target.path,
+                request.stream,
+                float("inf") if limit is None else limit + 1,
+                hashes.values(),
+            )
+            if limit is not None and written > limit:
+                error = ("Request Entity Too Large", 413)
+        for algorithm, digest in expected.items():
+            if not error and hashes[algorithm].digest() != digest:
+                error = ("Digest mismatch", 400)
+        if error:
+            os.unlink(temp)
+            return upload_error(*error)
+        sha256 = hashes["sha256"]
+        temp = blobs.commit(temp, sha256.hexdigest())
+        created = not os.path.exists(path)
+        rename_into_place(temp, path)
+        missing_paths.discard(path)
+
+        info = {"status": "success", "msg": "File Saved"}
+        info["sha256"] = sha256.hexdigest()
+        res = make_response(
+            json.JSONEncoder().encode(info), 201 if created else 200
+        )
+        res.headers.add("Content-type", "application/json")
+        res.headers["Digest"] = "SHA-256=" + base64.b64encode(
+            sha256.digest()
+        ).decode("ascii")
+        res.headers["Location"] = dir_url(target.path, root) + quote(name)
+        return res
+
+
+@app.route(api_prefix + "stats")
+def stats():
+    if not expose_stats:
+        return make_response("Not found", 404)
+    res = make_response(
+        json.JSONEncoder().encode(
+            {
+                "listing_cache": listing_cache.stats(),
+                "watcher": watcher and watcher.stats(),
+                "missing_paths": missing_paths.stats(),
+                "blob_store": blob_store and blobs.stats(),
+            }
+        ),
+        200,
+    )
+    res.headers.add("Content-type", "application/json")
+    return res
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class ResumableUpload:
+    # Chunks are written into a sparse .part file next to the destination
+    # and the byte ranges received so far into a .json journal beside it,
+    # so a session survives restarts and any worker can take any chunk
+    id_pattern = re.compile(r"^[0-9a-f]{32}$")
+    lock = threading.Lock()
+    # Directory -> when its stale sessions were last looked for
+    expired = {}
+
+    def __init__(self, directory, upload_id):
+        self.directory = directory
+        self.id = upload_id
+        base = os.path.join(directory, upload_prefix + upload_id)
+        self.part = base + ".part"
+        self.journal = base + ".json"
+        self.done = base + ".done"
+
+    @classmethod
+    def create(cls, directory, name, length):
+        cls.expire(directory)
+        upload = cls(directory, uuid.uuid4().hex)
+        try:
+            with open(upload.part, "xb") as fd:
+                fd.truncate(length)
+            upload.save({"name": name, "length": length, "ranges": []})
+        except Exception:
+            # A part without a journal would never expire
+            upload.abort()
+            raise
+        return upload
+
+    @classmethod
+    def find(cls, p):
+        directory, _, upload_id = p.rpartition("/")
+        target = resolve(directory)
+        if target is None or target.type != "dir":
+            return None
+        if not cls.id_pattern.match(upload_id):
+            return None
+        return cls(target.path, upload_id)
+
+    @classmethod
+    def expire(cls, directory):
+        # Scans the directory a few times per expiry period at most, not
+        # on every new session. Parts left without a journal by a crash
+        # go too
+        now = time.time()
+        if now - cls.expired.get(directory, 0) < upload_expiry / 24:
+            return
+        cls.expired[directory] = now
+        deadline = now - upload_expiry
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                base, ext = os.path.splitext(entry.name)
+                head, _, upload_id = base.partition(upload_prefix)
+                if head or not cls.id_pattern.match(upload_id):
+                    continue
+                if ext not in (".json", ".part", ".done"):
+                    continue
+                try:
+                    if entry.stat().st_mtime >= deadline:
+                        continue
+                except FileNotFoundError:
+                    continue
+                cls(directory, upload_id).abort()
+
+    def url(self):
+        return api_prefix + "uploads" + dir_url(self.directory, root) + self.id
+
+    def load(self):
+        try:
+            with open(self.journal) as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        temp = "{0}.{1}".format(self.journal, uuid.uuid4().hex)
+        with open(temp, "w") as fd:
+            json.dump(state, fd)
+        os.replace(temp, self.journal)
+
+    def write(self, offset, stream, length):
+        written = 0
+        with open(self.part, "r+b") as fd:
+            fd.seek(offset)
+            while written < length:
+                chunk = stream.read(min(chunk_size, length - written))
+                if not chunk:
+                    break
+                fd.write(chunk)
+                written += len(chunk)
+            # The journal must never claim bytes that are not on disk
+            fd.flush()
+            os.fsync(fd.fileno())
+        return written
+
+    def update(self, received=None):
+        # Records a received range, and renames the file into place once
+        # every byte is there. Returns None if the session is gone
+        with self.lock:
+            state = self.record(received)
+        if state is not None and state.get("complete"):
+            self.finish(state)
+        return state
+
+    def record(self, received):
+        # Under a lock shared by threads and worker processes. A complete
+        # upload is only moved aside here, so that no other session waits
+        # while it is hashed
+        try:
+            fd = os.open(self.part, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            state = self.load()
+            if state is None:
+                return None
+            if received:
+                state["ranges"] = merge_ranges(state["ranges"] + [received])
+            length = state["length"]
+            if not length or state["ranges"] == [[0, length]]:
+                os.replace(self.part, self.done)
+                os.unlink(self.journal)
+                state["complete"] = True
+            elif received:
+                self.save(state)
+            return state
+        finally:
+            os.close(fd)
+
+    def finish(self, state):
+        path = os.path.join(self.directory, state["name"])
+        done = self.done
+        try:
+            if blob_store:
+                # Chunks arrive out of order, so the hash is only known
+                # once the file is complete
+                done = blobs.commit(done, content_hash(done, os.stat(done)))
+            rename_into_place(done, path)
+        except OSError:
+            # Say a directory has taken the name since. The journal is
+            # already gone, so the session ends here either way
+            state["error"] = "Could not store the upload"
+            try:
+                os.unlink(done)
+            except OSError:
+                pass
+            return
+        missing_paths.discard(path)
+
+    def abort(self):
+        for path in (self.journal, self.part, self.done):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def upload_response(upload, state, status=200):
+    if "error" in state:
+        return upload_error(state["error"], 409)
+    complete = state.get("complete", False)
+    ranges = state["ranges"]
+    if complete:
+        offset = state["length"]
+    else:
+        offset = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    info = {
+        "status": "success",
+        "msg": "File Saved" if complete else "Upload in progress",
+        "offset": offset,
+        "complete": complete,
+    }
+    res = make_response(json.JSONEncoder().encode(info), status)
+    res.headers.add("Content-type", "application/json")
+    res.headers["Cache-Control"] = "no-store"
+    res.headers["Upload-Length"] = str(state["length"])
+    res.headers["Upload-Offset"] = str(offset)
+    # Inclusive, like HTTP byte ranges: what parallel clients still miss
+    res.headers["Upload-Ranges"] = ",".join(
+        "{0}-{1}".format(start, end - 1) for start, end in ranges
+    )
+    if complete:
+        res.headers["Location"] = dir_url(upload.directory, root) + quote(
+            state["name"]
+        )
+    else:
+        res.headers["Location"] = upload.url()
+    return res
+
+
+def upload_error(msg, status):
+    res = make_response(
+        json.JSONEncoder().encode({"status": "error", "msg": msg}), status
+    )
+    res.headers.add("Content-type", "application/json")
+    return res
+
+
+class UploadView(MethodView):
+    # Resumable uploads: POST <api_prefix>uploads/<dir>?name=<file> with an
+    # Upload-Length header opens a session at the returned Location, which
+    # takes PATCH (or PUT) chunks at Upload-Offset in any order, answers
+    # HEAD with the progress and is cancelled with DELETE
+    def post(self, p=""):
+        target = resolve(p)
+        if target is None or target.type != "dir":
+            return upload_error("Invalid Operation", 404)
+        name = secure_filename(request.args.get("name", ""))
+        try:
+            length = int(request.headers.get("Upload-Length"))
+        except (TypeError, ValueError):
+            length = -1
+        if not name or length < 0:
+            return upload_error("Invalid Operation", 400)
+        if os.path.isdir(os.path.join(target.path, name)):
+            return upload_error("A directory exists at this path", 409)
+        limit = request.max_content_length
+        if limit is not None and length > limit:
+            return upload_error("Request Entity Too Large", 413)
+        try:
+            upload = ResumableUpload.create(target.path, name, length)
+        except (OverflowError, OSError):
+            # Larger than the filesystem (or a C off_t) can hold
+            return upload_error("Request Entity Too Large", 413)
+        return upload_response(upload, upload.update(), 201)
+
+    def head(self, p=""):
+        upload = ResumableUpload.find(p)
+        state = upload and upload.load()
+        if state is None:
+            return upload_error("Not found", 404)
+        return upload_response(upload, state)
+
+    def patch(self, p=""):
+        upload = ResumableUpload.find(p)
+        state = upload and upload.load()
+        if state is None:
+            return upload_error("Not found", 404)
+        try:
+            offset = int(request.headers.get("Upload-Offset"))
+        except (TypeError, ValueError):
+            return upload_error("Missing Upload-Offset", 400)
+        remaining = state["length"] - offset
+        length = request.content_length
+        if length is None:
+            length = remaining
+        if offset < 0 or remaining < 0 or length > remaining:
+            return upload_error("Chunk outside of the upload", 409)
+        try:
+            written = upload.write(offset, request.stream, length)
+        except FileNotFoundError:
+            return upload_error("Not found", 404)
+        # An empty chunk must not show up as an inverted range
+        state = upload.update([offset, offset + written] if written else None)
+        if state is None:
+            return upload_error("Not found", 404)
+        return upload_response(upload, state)
+
+    put = patch
+
+    def delete(self, p=""):
+        upload = ResumableUpload.find(p)
+        if upload is None or upload.load() is None:
+            return upload_error("Not found", 404)
+        upload.abort()
+        return Response(status=204)
+
 
 path_view = PathView.as_view("path_view")
 app.add_url_rule("/", view_func=path_view)
 app.add_url_rule("/<path:p>", view_func=path_view)
+upload_view = UploadView.as_view("upload_view")
+app.add_url_rule(api_prefix + "uploads/", view_func=upload_view)
+app.add_url_rule(api_prefix + "uploads/<path:p>", view_func=upload_view)
 
 if __name__ == "__main__":
     app.run("0.0.0.0", 8000, threaded=True, debug=False)